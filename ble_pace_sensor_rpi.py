@@ -4,10 +4,12 @@ Bluetooth Low Energy Pace Sensor for Garmin Watch - Raspberry Pi Version
 Uses BlueZ D-Bus API for proper BLE peripheral advertising
 """
 
+import glob
 import struct
-import time
 import sys
+import queue
 import signal
+import socket
 from threading import Thread
 
 try:
@@ -30,6 +32,12 @@ RSC_FEATURE_UUID = "00002a54-0000-1000-8000-00805f9b34fb"
 PACE_KMH = 10.0  # Speed in km/h
 CADENCE_RPM = 85  # Steps per minute
 
+# Advertising interval in milliseconds (BlueZ default is ~100 ms). The
+# sensor only notifies once per second, so a slower interval saves airtime.
+# BlueZ only applies these when bluetoothd runs in experimental mode.
+ADV_MIN_INTERVAL_MS = 300
+ADV_MAX_INTERVAL_MS = 500
+
 # BlueZ D-Bus constants
 BLUEZ_SERVICE_NAME = 'org.bluez'
 GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
@@ -41,6 +49,9 @@ GATT_DESC_IFACE = 'org.bluez.GattDescriptor1'
 LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
 
+# Distances to report, drained by the status logger thread
+_log_q = queue.SimpleQueue()
+
 
 class Application(dbus.service.Object):
     """
@@ -49,26 +60,27 @@ class Application(dbus.service.Object):
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self._path_obj = dbus.ObjectPath(self.path)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
     def add_service(self, service):
         self.services.append(service)
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
-        response = {}
+        return dict(self._iter_objects())
+
+    def _iter_objects(self):
+        """Yield (path, properties) for every exported GATT object"""
         for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-        return response
+            yield service.get_path(), service.get_properties()
+            for chrc in service.get_characteristics():
+                yield chrc.get_path(), chrc.get_properties()
+                for desc in chrc.get_descriptors():
+                    yield desc.get_path(), desc.get_properties()
 
 
 class Service(dbus.service.Object):
@@ -83,30 +95,30 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
+        # Properties never change after construction, so build them once
+        self._path_obj = dbus.ObjectPath(self.path)
+        self._chr_paths = dbus.Array([], signature='o')
+        self._props = {
             GATT_SERVICE_IFACE: {
-                'UUID': self.uuid,
-                'Primary': self.primary,
-                'Characteristics': dbus.Array(
-                    self.get_characteristic_paths(),
-                    signature='o')
+                'UUID': dbus.String(uuid),
+                'Primary': dbus.Boolean(primary),
+                'Characteristics': self._chr_paths
             }
         }
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        return self._props
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self._chr_paths.append(characteristic.get_path())
 
     def get_characteristic_paths(self):
-        result = []
-        for chrc in self.characteristics:
-            result.append(chrc.get_path())
-        return result
+        return self._chr_paths
 
     def get_characteristics(self):
         return self.characteristics
@@ -131,32 +143,34 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
-        self.value = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
+        # Byte values are kept as dbus.ByteArray, which dbus-python marshals
+        # as 'ay' with a single copy instead of element by element
+        self.value = dbus.ByteArray(b'')
+        # Properties never change after construction, so build them once
+        self._path_obj = dbus.ObjectPath(self.path)
+        self._desc_paths = dbus.Array([], signature='o')
+        self._props = {
             GATT_CHRC_IFACE: {
-                'Service': self.service.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
-                'Descriptors': dbus.Array(
-                    self.get_descriptor_paths(),
-                    signature='o')
+                'Service': service.get_path(),
+                'UUID': dbus.String(uuid),
+                'Flags': dbus.Array(flags, signature='s'),
+                'Descriptors': self._desc_paths
             }
         }
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        return self._props
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self._desc_paths.append(descriptor.get_path())
 
     def get_descriptor_paths(self):
-        result = []
-        for desc in self.descriptors:
-            result.append(desc.get_path())
-        return result
+        return self._desc_paths
 
     def get_descriptors(self):
         return self.descriptors
@@ -201,7 +215,8 @@ class RSCMeasurementCharacteristic(Characteristic):
     """
     RSC Measurement Characteristic - provides speed and cadence data
     """
-    def __init__(self, bus, index, service, pace_sensor):
+    def __init__(self, bus, index, service, pace_sensor,
+                 ad_manager=None, advertisement=None):
         Characteristic.__init__(
             self, bus, index,
             RSC_MEASUREMENT_UUID,
@@ -209,29 +224,151 @@ class RSCMeasurementCharacteristic(Characteristic):
             service)
         self.notifying = False
         self.pace_sensor = pace_sensor
-
-    def update_measurement(self):
+        # Advertising is paused while a watch is receiving notifications
+        self.ad_manager = ad_manager
+        self.advertisement = advertisement
+        self._advertising = False
+        if advertisement:
+            advertisement.release_callback = self._on_advertisement_released
+        self.value = dbus.ByteArray(pace_sensor.get_packet())
+        # Socket handed out by AcquireNotify; None while BlueZ uses StartNotify
+        self._notify_sock = None
+        self._notify_watch = None
+        # Pending IO_OUT watch while the acquired socket is backed up
+        self._flush_watch = None
+        # Advertise AcquireNotify support to BlueZ
+        self._props[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(False)
+
+    def update_measurement(self, ticks=1):
         """Update the characteristic value with new measurement"""
         if not self.notifying:
             return
 
-        measurement = self.pace_sensor.get_measurement()
-        self.value = dbus.Array(measurement, signature='y')
-        
+        measurement = self.pace_sensor.get_measurement(ticks)
+
+        if self._notify_sock is not None:
+            # A flush is already waiting and will pick up this packet
+            if self._flush_watch is not None:
+                return
+            # Each datagram on the acquired socket is sent as one notification
+            try:
+                self._notify_sock.send(measurement)
+            except BlockingIOError:
+                # Link is backed up; send the latest packet once writable
+                self._flush_watch = GLib.io_add_watch(
+                    self._notify_sock.fileno(), GLib.PRIORITY_DEFAULT,
+                    GLib.IO_OUT, self._flush_notify)
+            except OSError:
+                self._release_notify()
+            return
+
+        self.value = dbus.ByteArray(measurement)
+
         self.PropertiesChanged(
             GATT_CHRC_IFACE,
             {'Value': self.value}, [])
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        """Hand BlueZ a socket to send notifications through directly"""
+        if self._notify_sock is not None:
+            self._close_notify_sock()
+
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        local.setblocking(False)
+        self._notify_sock = local
+        self._notify_watch = GLib.io_add_watch(
+            local.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_HUP | GLib.IO_ERR, self._on_notify_hup)
+        # UnixFd duplicates the descriptor, so our copy can be closed
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+        self._props[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(True)
+        self.StartNotify()
+
+        return fd, dbus.UInt16(options.get('mtu', 23))
+
+    def _flush_notify(self, fd, condition):
+        """Send the most recent packet once the acquired socket drains"""
+        try:
+            self._notify_sock.send(self.pace_sensor.get_packet())
+        except BlockingIOError:
+            return True  # Still backed up; keep waiting
+        except OSError:
+            self._flush_watch = None
+            self._release_notify()
+            return False
+        self._flush_watch = None
+        return False
+
+    def _on_notify_hup(self, fd, condition):
+        """BlueZ closes its end of the socket when notifications stop"""
+        self._notify_watch = None
+        self._release_notify()
+        return False
+
+    def _close_notify_sock(self):
+        if self._notify_watch is not None:
+            GLib.source_remove(self._notify_watch)
+            self._notify_watch = None
+        if self._flush_watch is not None:
+            GLib.source_remove(self._flush_watch)
+            self._flush_watch = None
+        self._notify_sock.close()
+        self._notify_sock = None
+        self._props[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(False)
+
+    def _release_notify(self):
+        self._close_notify_sock()
+        self.StopNotify()
+
+    def start_advertising(self):
+        """Register the advertisement with BlueZ unless already advertising"""
+        if self._advertising or not self.ad_manager:
+            return
+        self._advertising = True
+        self.ad_manager.RegisterAdvertisement(
+            self.advertisement.get_path(), {},
+            reply_handler=lambda: None,
+            error_handler=self._on_advertising_error)
+
+    def stop_advertising(self):
+        """Unregister the advertisement while a watch is connected"""
+        if not self._advertising:
+            return
+        self._advertising = False
+        self.ad_manager.UnregisterAdvertisement(
+            self.advertisement.get_path(),
+            reply_handler=lambda: None,
+            error_handler=self._on_unregister_error)
+
+    def _on_advertising_error(self, error):
+        self._advertising = False
+        print(f'❌ Failed to register advertisement: {error}')
+
+    def _on_unregister_error(self, error):
+        # The advertisement is still registered with BlueZ
+        self._advertising = True
+        print(f'⚠️  Failed to stop advertising: {error}')
+
+    def _on_advertisement_released(self):
+        # BlueZ dropped the advertisement (e.g. bluetoothd restart)
+        self._advertising = False
+
     def StartNotify(self):
         if self.notifying:
             return
         self.notifying = True
+        self.stop_advertising()
         print("✅ Garmin watch connected and receiving data!")
 
     def StopNotify(self):
         if not self.notifying:
             return
         self.notifying = False
+        self.start_advertising()
         print("⚠️  Watch disconnected")
 
 
@@ -247,21 +384,23 @@ class RSCFeatureCharacteristic(Characteristic):
             service)
         # Features: stride length, total distance, walking/running status
         features = 0b00000111
-        self.value = dbus.Array(struct.pack('<H', features), signature='y')
+        self.value = dbus.ByteArray(struct.pack('<H', features))
 
 
 class RSCService(Service):
     """
     Running Speed and Cadence Service
     """
-    def __init__(self, bus, index, pace_sensor):
+    def __init__(self, bus, index, pace_sensor,
+                 ad_manager=None, advertisement=None):
         Service.__init__(self, bus, index, RSC_SERVICE_UUID, True)
         
         # Add RSC Feature characteristic
         self.add_characteristic(RSCFeatureCharacteristic(bus, 0, self))
         
         # Add RSC Measurement characteristic
-        self.measurement_chrc = RSCMeasurementCharacteristic(bus, 1, self, pace_sensor)
+        self.measurement_chrc = RSCMeasurementCharacteristic(
+            bus, 1, self, pace_sensor, ad_manager, advertisement)
         self.add_characteristic(self.measurement_chrc)
 
 
@@ -282,9 +421,16 @@ class Advertisement(dbus.service.Object):
         self.local_name = 'Footpod'
         self.include_tx_power = False
         self.data = None
+        self.min_interval_ms = None
+        self.max_interval_ms = None
+        # Called when BlueZ releases the advertisement
+        self.release_callback = None
+        self._path_obj = dbus.ObjectPath(self.path)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
+        # Not cached: BlueZ only reads these when the advertisement is
+        # registered, and they must reflect the attributes at that time
         properties = dict()
         properties['Type'] = self.ad_type
         if self.service_uuids:
@@ -302,10 +448,14 @@ class Advertisement(dbus.service.Object):
             properties['IncludeTxPower'] = dbus.Boolean(self.include_tx_power)
         if self.data:
             properties['Data'] = dbus.Dictionary(self.data, signature='yv')
+        if self.min_interval_ms:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval_ms)
+        if self.max_interval_ms:
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval_ms)
         return {LE_ADVERTISEMENT_IFACE: properties}
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
     def add_service_uuid(self, uuid):
         if uuid not in self.service_uuids:
@@ -324,49 +474,93 @@ class Advertisement(dbus.service.Object):
                          out_signature='')
     def Release(self):
         print('Advertisement released')
+        if self.release_callback:
+            self.release_callback()
 
 
 class PaceSensor:
     """Pace sensor data calculator"""
+    __slots__ = ('pace_kmh', 'cadence_rpm', 'speed_mps', 'stride_length_m',
+                 'total_distance_m', '_dt', '_distance_per_tick',
+                 '_next_log_m', '_buf', '_pack_dist')
+
     def __init__(self, pace_kmh, cadence_rpm):
         self.pace_kmh = pace_kmh
         self.cadence_rpm = cadence_rpm
         self.speed_mps = pace_kmh / 3.6
         self.stride_length_m = (self.speed_mps / (cadence_rpm / 60.0)) if cadence_rpm > 0 else 0
         self.total_distance_m = 0
-        self.last_update_time = time.time()
-
-    def get_measurement(self):
-        """Generate RSC measurement data"""
-        # Update distance
-        current_time = time.time()
-        time_delta = current_time - self.last_update_time
-        self.total_distance_m += self.speed_mps * time_delta
-        self.last_update_time = current_time
-
-        # Build measurement packet
-        flags = 0b00000111  # Stride length present, total distance present, running
-        speed_encoded = int(self.speed_mps * 256)
-        cadence_encoded = self.cadence_rpm
-        stride_length_encoded = int(self.stride_length_m * 100)
-        total_distance_encoded = int(self.total_distance_m * 10)
-
-        measurement = struct.pack(
+        # Measurements are generated by a fixed 1 s timer, so distance is
+        # integrated per tick rather than from wall-clock deltas
+        self._dt = 1.0
+        self._distance_per_tick = self.speed_mps * self._dt
+        self._next_log_m = 100.0
+
+        # Flags, speed, cadence and stride never change, so the packet is
+        # packed once and only the total distance field is rewritten per tick
+        self._buf = bytearray(10)
+        struct.pack_into(
             '<BHBHI',
-            flags,
-            speed_encoded,
-            cadence_encoded,
-            stride_length_encoded,
-            total_distance_encoded
+            self._buf, 0,
+            0b00000111,  # Stride length present, total distance present, running
+            int(self.speed_mps * 256),
+            self.cadence_rpm,
+            int(self.stride_length_m * 100),
+            0
         )
+        self._pack_dist = struct.Struct('<I').pack_into
+
+    def get_packet(self):
+        """Return the current RSC measurement packet without updating it"""
+        return self._buf
+
+    def get_measurement(self, ticks=1):
+        """Generate RSC measurement data, advancing distance by ticks"""
+        # Update distance
+        self.total_distance_m += self._distance_per_tick * ticks
+
+        # Update total distance in place (offset 6, 0.1 m resolution)
+        self._pack_dist(self._buf, 6, int(self.total_distance_m * 10))
+
+        # Periodic status update (printed by the status logger thread)
+        if self.total_distance_m >= self._next_log_m:
+            self._next_log_m += 100.0
+            _log_q.put_nowait(self.total_distance_m)
+
+        return self._buf
+
+
+def status_logger(pace_sensor):
+    """Print queued status updates off the GLib main loop"""
+    while True:
+        distance_m = _log_q.get()
+        print(f"📊 Distance: {distance_m:.1f}m | "
+              f"Speed: {pace_sensor.pace_kmh:.1f} km/h | "
+              f"Cadence: {pace_sensor.cadence_rpm} RPM")
+
+
+def bluez_experimental_enabled():
+    """Best-effort check that bluetoothd runs with experimental features"""
+    try:
+        with open('/etc/bluetooth/main.conf') as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() == 'Experimental' and value.strip().lower() == 'true':
+                    return True
+    except OSError:
+        pass
 
-        # Periodic status update
-        if int(self.total_distance_m) % 100 < 2:
-            print(f"📊 Distance: {self.total_distance_m:.1f}m | "
-                  f"Speed: {self.pace_kmh:.1f} km/h | "
-                  f"Cadence: {self.cadence_rpm} RPM")
+    for path in glob.glob('/proc/[0-9]*/cmdline'):
+        try:
+            with open(path, 'rb') as f:
+                args = f.read().split(b'\0')
+        except OSError:
+            continue
+        if args[0].endswith(b'bluetoothd') and (
+                b'-E' in args or b'--experimental' in args):
+            return True
 
-        return measurement
+    return False
 
 
 def find_adapter(bus):
@@ -402,33 +596,57 @@ def main():
 
     # Create pace sensor
     pace_sensor = PaceSensor(PACE_KMH, CADENCE_RPM)
-
-    # Create GATT application
-    app = Application(bus)
-    service = RSCService(bus, 0, pace_sensor)
-    app.add_service(service)
-
-    # Register GATT application
-    service_manager = dbus.Interface(
-        bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
-        GATT_MANAGER_IFACE)
+    Thread(target=status_logger, args=(pace_sensor,), daemon=True).start()
 
     # Create advertisement
     adv = Advertisement(bus, 0, 'peripheral')
     adv.add_service_uuid(RSC_SERVICE_UUID)
     adv.local_name = 'Footpod'
+    adv.min_interval_ms = ADV_MIN_INTERVAL_MS
+    adv.max_interval_ms = ADV_MAX_INTERVAL_MS
 
     # Register advertisement
     ad_manager = dbus.Interface(
         bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
         LE_ADVERTISING_MANAGER_IFACE)
 
+    # Create GATT application
+    app = Application(bus)
+    service = RSCService(bus, 0, pace_sensor, ad_manager, adv)
+    app.add_service(service)
+
+    # Register GATT application
+    service_manager = dbus.Interface(
+        bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
+        GATT_MANAGER_IFACE)
+
     mainloop = GLib.MainLoop()
 
+    # Measurement schedule on GLib's monotonic clock (microseconds)
+    tick_us = 1000000
+    max_drift_us = 50000
+    next_deadline_us = 0
+    interval_ms = 1000
+
     def update_measurement():
         """Periodic update of measurement data"""
-        service.measurement_chrc.update_measurement()
-        return True  # Continue the timer
+        nonlocal next_deadline_us, interval_ms
+        now_us = GLib.get_monotonic_time()
+
+        # Credit every deadline that has passed, including any the loop
+        # missed while stalled, so no distance is lost
+        ticks = 1 + max(0, (now_us - next_deadline_us) // tick_us)
+        service.measurement_chrc.update_measurement(ticks)
+        next_deadline_us += ticks * tick_us
+
+        # Keep the current timer while it stays in phase with the schedule
+        delay_ms = (next_deadline_us - now_us) // 1000
+        if abs(delay_ms - interval_ms) * 1000 <= max_drift_us:
+            return True  # Continue the timer
+
+        interval_ms = delay_ms
+        GLib.timeout_add(interval_ms, update_measurement)
+        return False
 
     # Register GATT and advertising
     try:
@@ -436,9 +654,9 @@ def main():
                                             reply_handler=lambda: None,
                                             error_handler=lambda error: print(f'❌ Failed to register app: {error}'))
         
-        ad_manager.RegisterAdvertisement(adv.get_path(), {},
-                                         reply_handler=lambda: None,
-                                         error_handler=lambda error: print(f'❌ Failed to register advertisement: {error}'))
+        # Registered through the characteristic so it can pause advertising
+        # while a watch is connected
+        service.measurement_chrc.start_advertising()
 
         print("\n" + "="*60)
         print("🏃 BLE Footpod Sensor Started!")
@@ -449,6 +667,11 @@ def main():
         print(f"📏 Stride Length: {pace_sensor.stride_length_m:.2f} m")
         print(f"⏱️  Pace: {60 / pace_sensor.pace_kmh:.2f} min/km")
         print(f"\n🔵 Broadcasting RSC Service: {RSC_SERVICE_UUID}")
+        if bluez_experimental_enabled():
+            print(f"📶 Advertising interval: {ADV_MIN_INTERVAL_MS}-{ADV_MAX_INTERVAL_MS} ms")
+        else:
+            print("📶 Advertising interval: BlueZ default "
+                  "(enable bluetoothd experimental mode to apply ADV_*_INTERVAL_MS)")
         print("\n" + "="*60)
         print("📱 CONNECTING YOUR GARMIN WATCH:")
         print("="*60)
@@ -461,7 +684,8 @@ def main():
         print("\n⏸️  Press Ctrl+C to stop\n")
 
         # Update measurement every second
-        GLib.timeout_add_seconds(1, update_measurement)
+        next_deadline_us = GLib.get_monotonic_time() + tick_us
+        GLib.timeout_add(interval_ms, update_measurement)
 
         # Handle Ctrl+C
         def signal_handler(sig, frame):
@@ -8,8 +8,7 @@ This script works on Raspberry Pi with BlueZ
 
 import sys
 import asyncio
-import struct
-from datetime import datetime
+import time
 
 try:
     from bleak import BleakClient, BleakScanner
@@ -18,6 +17,8 @@ except ImportError:
     print("pip install bleak")
     sys.exit(1)
 
+from ftms_parse import compile_parser
+
 # Common NordicTrack/iFit FTMS (Fitness Machine Service) UUIDs
 FTMS_SERVICE_UUID = "00001826-0000-1000-8000-00805f9b34fb"
 TREADMILL_DATA_UUID = "00002acd-0000-1000-8000-00805f9b34fb"  # Treadmill Data
@@ -32,14 +33,24 @@ NORDICTRACK_SERVICE_UUID = "6e40fff0-b5a3-f393-e0a9-e50e24dcca9e"
 
 class NordicTrackTreadmill:
     """NordicTrack Treadmill BLE Client"""
+    __slots__ = ('client', 'device', 'speed_kmh', 'incline_percent',
+                 'distance_m', 'connected', 'debug', '_char_by_uuid',
+                 '_printer_task', '_disconnected', '_prev', '_parsers')
     
-    def __init__(self):
+    def __init__(self, debug=False):
         self.client = None
         self.device = None
         self.speed_kmh = 0.0
         self.incline_percent = 0.0
         self.distance_m = 0.0
         self.connected = False
+        self.debug = debug
+        self._char_by_uuid = {}
+        self._printer_task = None
+        self._disconnected = asyncio.Event()
+        self._prev = b''
+        # Generated parsers keyed by the Treadmill Data flags they handle
+        self._parsers = {}
         
     async def scan_for_treadmill(self, timeout=10.0):
         """Scan for NordicTrack treadmill"""
@@ -82,14 +93,25 @@ class NordicTrackTreadmill:
             self.device = device_address
         
         try:
-            self.client = BleakClient(self.device)
+            self.client = BleakClient(
+                self.device,
+                disconnected_callback=self._on_disconnect
+            )
             await self.client.connect()
             self.connected = True
             
             print(f"✅ Connected to {self.device.name if hasattr(self.device, 'name') else self.device}")
             
+            # Map characteristic UUIDs once so subscriptions skip bleak's lookup
+            self._char_by_uuid = {
+                char.uuid: char
+                for service in self.client.services
+                for char in service.characteristics
+            }
+            
             # Discover services
-            await self._discover_services()
+            if self.debug:
+                await self._discover_services()
             
             return True
             
@@ -114,6 +136,15 @@ class NordicTrackTreadmill:
                 if char.description:
                     print(f"     Description: {char.description}")
     
+    def _on_disconnect(self, client):
+        """Called by bleak when the treadmill drops the connection"""
+        self.connected = False
+        self._disconnected.set()
+    
+    async def wait_for_disconnect(self):
+        """Wait until the treadmill disconnects"""
+        await self._disconnected.wait()
+    
     def _parse_treadmill_data(self, data: bytearray):
         """
         Parse FTMS Treadmill Data characteristic
@@ -122,61 +153,48 @@ class NordicTrackTreadmill:
         if len(data) < 3:
             return
         
-        # Parse flags (first 2 bytes, little-endian)
-        flags = struct.unpack('<H', data[0:2])[0]
-        
-        offset = 2
-        
-        # Bit 0: More data flag
-        # Bit 1: Average Speed present
-        instantaneous_speed_present = flags & 0x01
+        flags = data[0] | data[1] << 8
+        parser = self._parsers.get(flags)
+        if parser is None:
+            # First packet with this field layout; compile a parser for it
+            parser = self._parsers[flags] = compile_parser(flags)
+            if self.debug:
+                print(f"🔧 Compiled parser for Treadmill Data flags 0x{flags:04x}")
         
         try:
-            # Instantaneous Speed (uint16, km/h with 0.01 resolution)
-            if instantaneous_speed_present and len(data) >= offset + 2:
-                speed_raw = struct.unpack('<H', data[offset:offset+2])[0]
-                self.speed_kmh = speed_raw * 0.01
-                offset += 2
-            
-            # Average Speed (if present)
-            if (flags & 0x02) and len(data) >= offset + 2:
-                offset += 2
-            
-            # Total Distance (uint24, meters with 1m resolution)
-            if (flags & 0x04) and len(data) >= offset + 3:
-                distance_bytes = data[offset:offset+3] + b'\x00'  # Pad to 4 bytes
-                self.distance_m = struct.unpack('<I', distance_bytes)[0]
-                offset += 3
-            
-            # Inclination (sint16, percentage with 0.1 resolution)
-            if (flags & 0x08) and len(data) >= offset + 2:
-                incline_raw = struct.unpack('<h', data[offset:offset+2])[0]
-                self.incline_percent = incline_raw * 0.1
-                offset += 2
-            
-            # Ramp Angle Setting (sint16, degrees with 0.1 resolution)
-            if (flags & 0x10) and len(data) >= offset + 2:
-                offset += 2
-            
-            # Remaining fields...
-            
+            (self.speed_kmh,
+             self.distance_m,
+             self.incline_percent) = parser(
+                data, self.speed_kmh, self.distance_m, self.incline_percent)
         except Exception as e:
             print(f"⚠️  Parse error: {e}")
     
     def _notification_handler(self, sender, data: bytearray):
         """Handle notifications from treadmill"""
-        self._parse_treadmill_data(data)
-        
-        # Print current stats
+        # Constant-speed treadmills repeat the same payload; skip re-parsing
+        payload = bytes(data)
+        if payload == self._prev:
+            return
+        self._parse_treadmill_data(payload)
+        self._prev = payload
+    
+    def _format_stats(self):
+        """Format the latest treadmill stats as a status line"""
         pace_min_per_km = (60 / self.speed_kmh) if self.speed_kmh > 0 else 0
         pace_min = int(pace_min_per_km)
         pace_sec = int((pace_min_per_km - pace_min) * 60)
         
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        print(f"[{timestamp}] 🏃 Speed: {self.speed_kmh:5.1f} km/h | "
-              f"Pace: {pace_min}:{pace_sec:02d} min/km | "
-              f"Incline: {self.incline_percent:4.1f}% | "
-              f"Distance: {self.distance_m:6.0f}m")
+        timestamp = time.strftime("%H:%M:%S")
+        return (f"[{timestamp}] 🏃 Speed: {self.speed_kmh:5.1f} km/h | "
+                f"Pace: {pace_min}:{pace_sec:02d} min/km | "
+                f"Incline: {self.incline_percent:4.1f}% | "
+                f"Distance: {self.distance_m:6.0f}m")
+    
+    async def _printer(self):
+        """Print current stats once per second, off the notification path"""
+        while True:
+            await asyncio.sleep(1.0)
+            print(self._format_stats())
     
     async def start_notifications(self):
         """Subscribe to treadmill data notifications"""
@@ -185,10 +203,11 @@ class NordicTrackTreadmill:
         # Try FTMS Treadmill Data characteristic
         try:
             await self.client.start_notify(
-                TREADMILL_DATA_UUID,
+                self._char_by_uuid.get(TREADMILL_DATA_UUID, TREADMILL_DATA_UUID),
                 self._notification_handler
             )
             print("✅ Subscribed to Treadmill Data")
+            self._printer_task = asyncio.create_task(self._printer())
             return True
         except Exception as e:
             print(f"⚠️  Could not subscribe to Treadmill Data: {e}")
@@ -196,10 +215,11 @@ class NordicTrackTreadmill:
         # Try Indoor Bike Data as fallback (some treadmills use this)
         try:
             await self.client.start_notify(
-                INDOOR_BIKE_DATA_UUID,
+                self._char_by_uuid.get(INDOOR_BIKE_DATA_UUID, INDOOR_BIKE_DATA_UUID),
                 self._notification_handler
             )
             print("✅ Subscribed to Indoor Bike Data")
+            self._printer_task = asyncio.create_task(self._printer())
             return True
         except Exception as e:
             print(f"⚠️  Could not subscribe to Indoor Bike Data: {e}")
@@ -209,6 +229,9 @@ class NordicTrackTreadmill:
     
     async def disconnect(self):
         """Disconnect from treadmill"""
+        if self._printer_task:
+            self._printer_task.cancel()
+            self._printer_task = None
         if self.client and self.connected:
             await self.client.disconnect()
             self.connected = False
@@ -220,7 +243,8 @@ async def main():
     print("  NordicTrack Treadmill Bluetooth Reader")
     print("=" * 60)
     
-    treadmill = NordicTrackTreadmill()
+    # Pass --debug to list the treadmill's services after connecting
+    treadmill = NordicTrackTreadmill(debug='--debug' in sys.argv)
     
     # Connect to treadmill
     # You can specify an address like: await treadmill.connect("XX:XX:XX:XX:XX:XX")
@@ -248,10 +272,10 @@ async def main():
     print("=" * 60 + "\n")
     
     try:
-        # Keep running and receiving notifications
-        while True:
-            await asyncio.sleep(1)
-            
+        # Keep running and receiving notifications until disconnected
+        await treadmill.wait_for_disconnect()
+        print("\n⚠️  Treadmill disconnected")
+        
     except KeyboardInterrupt:
         print("\n\n⏹️  Stopping...")
     finally: